@@ -10,7 +10,9 @@
 # python ./klippy/klippy.py ~/printer.cfg -o test.serial -v -d out/klipper.dict
 # python ./klippy/parsedump.py out/klipper.dict test.serial > test.txt
 
-import math
+import binascii
+import re
+import struct
 from . import font8x14
 from .. import bus
 import logging
@@ -28,6 +30,20 @@ MAX_BYTES_TO_KEEP_PENDING = 45 # max payload to keep pending.
 MAX_NR_CONSECUTIVE_UNCHANGED_PIXELS = 3 # max nr. of consecutive unchanged
                                         # pixels before a new RASET is issued
 
+ROWS_PER_BLOCK = 16 # nr. of rows compared at once when looking for changes
+
+LITERAL_BUFFER_SIZE = 2048 # bytes of literal pixel data collected before they
+                           # are passed on to the stream, must be even
+
+# Matches a run of changed pixels, including any short unchanged gaps that
+# are not worth issuing a new RASET for.
+CHANGED_PIXELS_RE = re.compile('1+(?:0{1,%d}1+)*'
+                               % (MAX_NR_CONSECUTIVE_UNCHANGED_PIXELS,))
+# Splits pixels into runs of at least two identical pixels (group 1), which
+# are sent as repeating data, and sequences of alternating single pixels
+# (group 2), which are sent as literal data.
+PACKBITS_RUN_RE = re.compile('(0{2,}|1{2,})|((?:0(?!0)|1(?!1))+)')
+
 # Registers        
 ST7796S_CSCON   =  0xF0 # Command Set Control
 ST7796S_MADCTL  =  0x36 # Memory Data Access Control
@@ -52,11 +68,17 @@ ST7796S_RAMWR   =  0x2C # Memory write
 ST7796S_RASET   =  0x2B # Raset
 ST7796S_CASET   =  0x2A # Caset
 
+# CASET/RASET command followed by the (big endian) start and end address
+ADDRESS_CMD = struct.Struct('>BHH')
+
 #MAX_ROW = 240
 #MAX_COLUMN = 320
 MAX_ROW = 320
 MAX_COLUMN = 480
 
+# Cache the 14 rows of each font character that are actually drawn
+FONT = [bytearray(c[:14]) for c in font8x14.VGA_FONT]
+
 TEXTGLYPHS = {
     'right_arrow': '\x1a',
     'degrees': '\xf8',
@@ -67,11 +89,60 @@ class ST7796sParseException(Exception):
         super(ST7796sParseException, self).__init__(value)
         self.value = value
 
+def _to_long(data):
+    # Convert packed pixel data to a single (big endian) integer
+    if not data:
+        return 0
+    return int(binascii.hexlify(data), 16)
+
+def _from_long(value, nr_bytes):
+    # Convert an integer back to nr_bytes of packed pixel data
+    return binascii.unhexlify('%0*x' % (2 * nr_bytes, value))
+
+def _to_bit_string(value, nr_bits):
+    # Convert an integer to a string of '0' and '1' characters, one per pixel
+    return bin(value)[2:].zfill(nr_bits)
+
+def _get_pixel_bits(pixeldata, begin, end):
+    # Returns pixels [begin, end) of the packed pixel data as a bit string
+    end = min(8 * len(pixeldata), end)
+    if begin >= end:
+        return ''
+
+    first_byte = begin // 8
+    last_byte = (end + 7) // 8
+    data = pixeldata[first_byte:last_byte]
+
+    # Spans of a single color (typically the background) are detected with a
+    # byte scan, without converting them pixel by pixel.
+    if not data.strip(b'\x00'):
+        return '0' * (end - begin)
+    if not data.strip(b'\xff'):
+        return '1' * (end - begin)
+
+    bits = _to_bit_string(_to_long(data), 8 * len(data))
+    offset = begin - 8 * first_byte
+    return bits[offset:offset + end - begin]
+
+def _make_pixel_table(bg_value, fg_value):
+    # Translation table mapping '0' and '1' pixels to the given byte values
+    table = bytearray(256)
+    table[ord('0')] = bg_value
+    table[ord('1')] = fg_value
+    return bytes(table)
+
+def _parse_number(value):
+    # Plain integers are parsed directly, anything else is rounded down
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value) // 1)
+
 def _parse_rect(rect_string):
     components = rect_string.split(',')
 
     try:
-        elements = tuple(int(math.floor(float(p.strip()))) for p in components)
+        elements = tuple(_parse_number(p.strip()) for p in components)
     except ValueError:
         raise ST7796sParseException("Malformed rectangle '%s'"
                                     % (rect_string,))
@@ -96,7 +167,7 @@ def _parse_color(color_string):
     components = color_string.split(',')
 
     try:
-        elements = tuple(max(0, min(255, math.floor(float(p.strip()))))
+        elements = tuple(max(0, min(255, _parse_number(p.strip())))
                          for p in components)
     except ValueError:
         raise ST7796sParseException("Malformed color '%s'" % (color_string,))
@@ -105,44 +176,44 @@ def _parse_color(color_string):
         raise ST7796sParseException("Malformed color '%s'" % (color_string,))
 
     # convert to RGB565
-    _r = int(elements[0])
-    _g = int(elements[1])
-    _b = int(elements[2])
+    _r, _g, _b = elements
 
     color = ((_r // 8) << 11) | ((_g // 4) << 5) | (_b // 8)
 
     return color
 
+def _make_glyph_table():
+    # Translation table mapping glyph pixels ('.' and '*') to '0' and '1'
+    table = bytearray(range(256))
+    table[ord('.')] = ord('0')
+    table[ord('*')] = ord('1')
+    return bytes(table)
+
+GLYPH_TO_BITS = _make_glyph_table()
+
+# Translation table mapping zero bytes to '0' and all others to '1'
+BINARY_CONTENT_TABLE = b'0' + b'1' * 255
+
 def _parse_glyph(data):
     glyph_data = []
     width = None
     height = 0
 
     for line in data.split('\n'):
-        line = line.strip().replace('.', '0').replace('*', '1')
+        line = line.strip()
         if not line:
             continue
         height = height + 1
         if width is None:
             width = len(line)
-        elif len(line) != width or line.replace('0', '').replace('1', ''):
+        if len(line) != width or line.strip('.*'):
             raise ST7796sParseException("Invalid glyph line %d" % (height,))
 
-        linedata = bytearray((width+7) // 8)
-        index = 0
-        while line:
-            this_chunk = line[0:8]
-            line = line[8:]
-
-            # pad chunk if less than 8 pixels wide
-            chunk_length = len(this_chunk)
-            if chunk_length != 8:
-                this_chunk += '0' * (8 - chunk_length)
-
-            linedata[index] = int(this_chunk, 2)
-            index += 1
-
-        glyph_data.append(linedata)
+        # convert the complete line at once, padded to a multiple of 8 pixels
+        nr_bytes = (width + 7) // 8
+        bits = line.encode('ascii').translate(GLYPH_TO_BITS)
+        bits += b'0' * (8 * nr_bytes - width)
+        glyph_data.append(bytearray(_from_long(int(bits, 2), nr_bytes)))
 
     return glyph_data, width, height
 
@@ -206,67 +277,6 @@ class ResetHelper(object):
         minclock = self.mcu.print_time_to_clock(print_time)
         self.mcu_resx.update_digital_out(1, minclock=minclock)
 
-class PixelRunIterator(object):
-    def __init__(self, pixeldata, begin = 0, end = None):
-        self.data = pixeldata
-
-        if not end:
-            end = 8 * len(pixeldata)
-        else:
-            end = min(8 * len(pixeldata), end)
-
-        self.next_index = begin // 8
-        self.current_bit = 0x80 >> (begin & 7)
-
-        if self.next_index < len(self.data) and begin < end:
-            self.current_byte = self.data[self.next_index]
-            self.remaining = end - begin
-        else:
-            self.current_byte = 0
-            self.remaining = 0
-        self.next_index += 1
-
-    def __iter__(self):
-        return self
-
-    def __next__(self):
-        if self.remaining == 0:
-            raise StopIteration
-
-        thisbit = ((self.current_byte & self.current_bit) != 0)
-        full_byte = 0xff if thisbit else 0
-
-        count = 1
-
-        while True:
-            self.remaining -= 1
-            if self.remaining == 0:
-                break
-
-            self.current_bit >>= 1
-            if self.current_bit == 0:
-                self.current_bit = 0x80
-                while True:
-                    self.current_byte = self.data[self.next_index]
-                    self.next_index += 1
-                    if self.current_byte != full_byte or self.remaining < 8:
-                        break
-                    count += 8
-                    self.remaining -= 8
-                    if self.remaining == 0:
-                        break
-
-            if self.remaining == 0:
-                break
-
-            if ((self.current_byte & self.current_bit) != 0) != thisbit:
-                break
-            count = count + 1
-
-        return thisbit, count
-    def next(self): # python 2 compatibility
-        return self.__next__()
-
 class PackBitsStream(object):
     LITERAL=-1
     LITERAL_DCX=-2
@@ -278,6 +288,19 @@ class PackBitsStream(object):
     def add_command(self, data):
         self._extend_buffer(PackBitsStream.LITERAL_DCX, data)
 
+    def add_commands(self, cmds):
+        # Keep a group of commands in a single request whenever possible.
+        # The request is sent once MAX_BYTES_TO_KEEP_PENDING is reached, so
+        # only the last command of the group may reach that limit.
+        size = sum(len(cmd) + 1 for cmd in cmds)
+        last_size = len(cmds[-1]) + 1
+        if (size > MAX_BYTES_IN_REQUEST - len(self.buffer) or
+                len(self.buffer) + size - last_size
+                >= MAX_BYTES_TO_KEEP_PENDING):
+            self.flush()
+        for cmd in cmds:
+            self._extend_buffer(PackBitsStream.LITERAL_DCX, cmd)
+
     def add_literal_data(self, data):
         data_len = len(data)
         for write_pos in range(0, data_len, 64):
@@ -288,37 +311,37 @@ class PackBitsStream(object):
     def add_repeating_data(self, runlength, data):
         while runlength > 0:
             section = min(129, runlength)
+            if runlength - section == 1:
+                # A single repeat can't be encoded, so leave two for the
+                # next section instead.
+                section -= 1
             runlength -= section
             self._extend_buffer(section, data)
 
     def _extend_buffer(self, header, data):
-        if not data:
-            return
-        remaining = MAX_BYTES_IN_REQUEST - len(self.buffer) - 1
-
-        if len(data) > remaining:
-            # data will not fit
-            if header == PackBitsStream.LITERAL:
-                self._extend_buffer(PackBitsStream.LITERAL,
-                                    data[:remaining])
-                self._extend_buffer(PackBitsStream.LITERAL, data[remaining:])
-            elif header == PackBitsStream.LITERAL_DCX:
-                # Assert DCX on first write
-                self._extend_buffer(PackBitsStream.LITERAL_DCX,
-                                    data[:remaining])
-                self._extend_buffer(PackBitsStream.LITERAL, data[remaining:])
-            else:
-                # flush and try again
-                self.flush()
-                self._extend_buffer(header, data)
-        else:
-            if header == PackBitsStream.LITERAL:
-                self.buffer.append(len(data) + 63)
-            elif header == PackBitsStream.LITERAL_DCX:
-                self.buffer.append(len(data) - 1)
+        while data:
+            remaining = MAX_BYTES_IN_REQUEST - len(self.buffer) - 1
+
+            if header >= 0:
+                # repeat, which cannot be split
+                if len(data) > remaining:
+                    # flush and try again
+                    self.flush()
+                    continue
+                self.buffer.append(header + 126)
+                chunk = data
+                data = None
             else:
-                self.buffer.append(header + 126) # repeat
-            self.buffer.extend(data)
+                # literal data is split over as many requests as needed
+                chunk = data[:remaining]
+                data = data[remaining:]
+                if header == PackBitsStream.LITERAL:
+                    self.buffer.append(len(chunk) + 63)
+                else:
+                    self.buffer.append(len(chunk) - 1)
+                # Only assert DCX on the first write
+                header = PackBitsStream.LITERAL
+            self.buffer.extend(chunk)
 
             if len(self.buffer) >= MAX_BYTES_TO_KEEP_PENDING:
                 self.flush()
@@ -333,17 +356,28 @@ class PackBitsStream(object):
 class BitmapWriterHelper(object):
     def __init__(self, display, fgcolor, bgcolor, start_x, start_y):
         self.stream = PackBitsStream(display.oid, display.send_cmd)
-        self.fgcolor = fgcolor
-        self.bgcolor = bgcolor
+
+        # Background and foreground color, as sent to the display
+        self.color_bytes = (struct.pack('>H', bgcolor),
+                            struct.pack('>H', fgcolor))
+
+        # Tables translating pixels into the high and low byte of their color
+        self.hi_table = _make_pixel_table((bgcolor >> 8) & 0xff,
+                                          (fgcolor >> 8) & 0xff)
+        self.lo_table = _make_pixel_table(bgcolor & 0xff, fgcolor & 0xff)
 
         self.start_x = start_x
         self.start_y = start_y
 
-        self.literal_buffer = None
+        # Pending literal pixels are collected in the first literal_length
+        # bytes of a fixed size buffer.
+        self.literal_buffer = bytearray(LITERAL_BUFFER_SIZE)
+        self.literal_length = 0
 
         self.last_row = None
         self.last_begin = None
         self.last_end = None
+        self.window_row = None # first row of the current RASET window
 
     def flush(self):
         if self.last_row != None:
@@ -352,70 +386,78 @@ class BitmapWriterHelper(object):
             self.stream.flush()
 
     def _flush_literal_buffer(self):
-        if not self.literal_buffer:
+        if not self.literal_length:
             return
 
-        self.stream.add_literal_data(self.literal_buffer)
+        self.stream.add_literal_data(
+            memoryview(self.literal_buffer)[:self.literal_length])
 
-        self.literal_buffer = None
+        self.literal_length = 0
 
     def write(self, row, data, begin, end):
+        self.write_rows(row, 1, begin, end, _get_pixel_bits(data, begin, end))
+
+    def write_rows(self, row, nr_rows, begin, end, bits):
+        # Writes pixels [begin, end) of nr_rows consecutive rows starting at
+        # row. The bit string holds the pixels of all rows back to back, and
+        # is sent as a single pixel stream.
         if  begin != self.last_begin or end != self.last_end:
             caset_update = True
-            raset_update = not self.last_row or self.last_row != row
+            # RAMWR restarts at the first row of the window
+            raset_update = self.window_row != row
         else:
             caset_update = False
-            raset_update = not self.last_row or (self.last_row+1) != row
+            raset_update = self.last_row is None or (self.last_row+1) != row
 
         self.last_begin = begin
         self.last_end = end
-        self.last_row = row
+        self.last_row = row + nr_rows - 1
 
         if caset_update or raset_update:
             # Finish previous pixel stream
             self._flush_literal_buffer()
 
-        if caset_update:
-            x_begin = begin + self.start_x
-            x_end = end + self.start_x - 1 # CASET end column is included!
-
-            self.stream.add_command(
-              [ST7796S_CASET, # CASET
-                (x_begin >> 8) & 0xff,
-                x_begin & 0xff,
-                (x_end >> 8) & 0xff,
-                x_end & 0xff
-              ])
-        if raset_update:
-            y_begin = row + self.start_y
-            y_end = MAX_ROW - 1
-
-            self.stream.add_command(
-              [ST7796S_RASET, # RASET
-                (y_begin >> 8) & 0xff, 
-                y_begin & 0xff, 
-                (y_end >> 8) & 0xff,
-                y_end & 0xff
-              ])
+            cmds = []
+            if caset_update:
+                x_begin = begin + self.start_x
+                x_end = end + self.start_x - 1 # CASET end column is included!
 
-        if caset_update or raset_update:
-            # start new pixel stream
-            self.stream.add_command([ST7796S_RAMWR]) # data, no continuation
+                cmds.append(ADDRESS_CMD.pack(ST7796S_CASET, x_begin, x_end))
+            if raset_update:
+                y_begin = row + self.start_y
+                y_end = MAX_ROW - 1
 
-        for is_foreground, runlength in PixelRunIterator(data, begin, end):
-            value = self.fgcolor if is_foreground else self.bgcolor
+                cmds.append(ADDRESS_CMD.pack(ST7796S_RASET, y_begin, y_end))
+                self.window_row = row
 
-            hi = (value >> 8) & 0xff
-            lo = value & 0xff
+            # start new pixel stream
+            cmds.append([ST7796S_RAMWR]) # data, no continuation
+            self.stream.add_commands(cmds)
 
-            if runlength < 2:
-                if not self.literal_buffer:
-                    self.literal_buffer = bytearray([hi, lo])
-                else:
-                    self.literal_buffer.extend([hi, lo])
-            else:
+        for repeat, literal in PACKBITS_RUN_RE.findall(bits):
+            if repeat:
                 self._flush_literal_buffer()
-                self.stream.add_repeating_data(runlength, [hi, lo])
+                self.stream.add_repeating_data(
+                    len(repeat), self.color_bytes[repeat[0] == '1'])
+            else:
+                # Expand the pixels to their 16 bit colors, as many at once
+                # as fit in the literal buffer
+                literal = literal.encode('ascii')
+                literal_pos = 0
+                while literal_pos < len(literal):
+                    if self.literal_length == LITERAL_BUFFER_SIZE:
+                        self._flush_literal_buffer()
+                    pos = self.literal_length
+                    nr_pixels = min(len(literal) - literal_pos,
+                                    (LITERAL_BUFFER_SIZE - pos) // 2)
+                    pixels = literal[literal_pos:literal_pos + nr_pixels]
+                    pos_end = pos + 2 * nr_pixels
+                    self.literal_buffer[pos:pos_end:2] = pixels.translate(
+                        self.hi_table)
+                    self.literal_buffer[pos + 1:pos_end:2] = pixels.translate(
+                        self.lo_table)
+                    self.literal_length = pos_end
+                    literal_pos += nr_pixels
 
 class Framebuffer(object):
     def __init__(self, display, origin_x, origin_y,
@@ -430,72 +472,97 @@ class Framebuffer(object):
         self.bgcolor = bgcolor
         self.icons = {}
 
+        # All rows are stored back to back in a single bytearray, each row
+        # taking up row_size bytes of which the first row_bytes are shown.
+        self.row_size = size_x
+        self.row_bytes = (size_x + 7) // 8
+
         self.framebuffer = self.__makebuffer()
-        self.old_framebuffer = [None for _i in range(self.size_y)]
+        self.old_framebuffer = None # Nothing has been sent to the display yet
 
         self.nr_columns = size_x // 8
         self.nr_rows = size_y // 16
 
     def __makebuffer(self):
         # we are working with pixels not columns
-        return [bytearray(self.size_x) for _i in range(self.size_y)]
-        #return [bytearray((self.size_x+7)//8) for _i in range(self.size_y)]
+        return bytearray(self.row_size * self.size_y)
+
+    def _get_row(self, framebuffer, row):
+        offset = row * self.row_size
+        return framebuffer[offset:offset + self.row_bytes]
+
+    def _get_changed_blocks(self):
+        # Compare blocks of rows first, so unchanged areas of the display are
+        # skipped using a single comparison. Yields the first and last + 1 row
+        # of every block that differs.
+        for block_row in range(0, self.size_y, ROWS_PER_BLOCK):
+            start = block_row * self.row_size
+            end = start + ROWS_PER_BLOCK * self.row_size
+            if self.old_framebuffer[start:end] == self.framebuffer[start:end]:
+                continue
+            yield block_row, min(block_row + ROWS_PER_BLOCK, self.size_y)
 
     def flush(self):
+        if self.old_framebuffer is None:
+            # Nothing has been sent yet, so every pixel has to be written
+            self.full_flush()
+            return
+
         writer = BitmapWriterHelper(
             self.display, self.fgcolor, self.bgcolor,
             self.origin_x, self.origin_y)
-        
-        for row in range(self.size_y):
-            old_row = self.old_framebuffer[row]
-            new_row = self.framebuffer[row]
-            for begin, end in Framebuffer.get_pixel_changes(old_row, new_row,
-                                                            self.size_x):
-                writer.write(row, new_row, begin, end)
-            
+
+        for first_row, end_row in self._get_changed_blocks():
+            for row in range(first_row, end_row):
+                old_row = self._get_row(self.old_framebuffer, row)
+                new_row = self._get_row(self.framebuffer, row)
+                changes = Framebuffer.get_pixel_changes(old_row, new_row,
+                                                        self.size_x)
+                for begin, end in changes:
+                    writer.write(row, new_row, begin, end)
+
+            # All visible changes of the block have been sent. Remember the
+            # whole block, including the bytes that aren't shown, so it
+            # compares equal again on the next flush.
+            start = first_row * self.row_size
+            end = end_row * self.row_size
+            self.old_framebuffer[start:end] = self.framebuffer[start:end]
+
         writer.flush()
-        self.old_framebuffer[:] = self.framebuffer
 
     def full_flush(self):
         writer = BitmapWriterHelper(
             self.display, self.fgcolor, self.bgcolor,
             self.origin_x, self.origin_y)
 
-        for row in range(self.size_y):
-            new_row = self.framebuffer[row]
-            writer.write(row, new_row, 0, self.size_x)
-            
+        bits = ''.join([
+            _get_pixel_bits(self._get_row(self.framebuffer, row),
+                            0, self.size_x)
+            for row in range(self.size_y)])
+        writer.write_rows(0, self.size_y, 0, self.size_x, bits)
+
         writer.flush()
-        self.old_framebuffer[:] = self.framebuffer
+        self.old_framebuffer = bytearray(self.framebuffer)
 
     @staticmethod
     def get_pixel_changes(old_row, new_row, row_width):
-        if old_row == None:
+        if old_row is None:
             return [(0, row_width)] # Issue full change
 
         if old_row == new_row:
             return [] # shortcut for identical data.
 
-        differences = bytearray([ b1 ^ b2 for b1, b2 in zip(old_row, new_row)])
-        changes = []
-
-        merge_with_last = False
-        current = 0
+        # Compare the rows as big integers, so both the XOR and the expansion
+        # to individual pixels are performed by the interpreter rather than
+        # in a python loop.
+        nr_bytes = min((row_width + 7) // 8, len(new_row))
+        differences = (_to_long(old_row[:nr_bytes])
+                       ^ _to_long(new_row[:nr_bytes]))
+        if not differences:
+            return []
 
-        for value, runlength in PixelRunIterator(differences, 0, row_width):
-            begin = current
-            current += runlength
-            end = begin + runlength # exclusive
-
-            if  value:
-                if merge_with_last:
-                    merge_with_last = False
-                    begin = changes.pop()[0]
-
-                changes.append((begin, end))
-            elif runlength <= MAX_NR_CONSECUTIVE_UNCHANGED_PIXELS and changes:
-                merge_with_last = True # Suppress RASET change for this run
-        return changes
+        bits = _to_bit_string(differences, 8 * nr_bytes)[:row_width]
+        return [match.span() for match in CHANGED_PIXELS_RE.finditer(bits)]
 
     def write_glyph(self, _x, _y, glyph_name):
         icon = self.icons.get(glyph_name)
@@ -520,41 +587,45 @@ class Framebuffer(object):
         for glyph_name, glyph_data in glyphs.items():
             icon = glyph_data.get('icon16x16')
             if icon is not None:
-                self.icons[glyph_name] = icon
+                # Store the columns in the format used by the framebuffer
+                self.icons[glyph_name] = tuple(bytearray(column)
+                                               for column in icon)
 
     def write_text(self, _x, _y, data):
         if _x + len(data) > self.nr_columns:
             data = data[:self.nr_columns - min(_x, self.nr_columns)]
 
-        top_row = 16 * _y
+        offset = 16 * _y * self.row_size + _x
 
+        # Each character is a column of 14 bytes, which is written using a
+        # single extended slice assignment.
+        stride = self.row_size
         for char in data:
-            font_char = font8x14.VGA_FONT[ord(char)]
-            for row in range(14):
-                self.framebuffer[top_row + row][_x] = font_char[row]
-            _x += 1
+            end = offset + 14 * stride
+            self.framebuffer[offset:end:stride] = FONT[ord(char)]
+            offset += 1
 
     def write_graphics(self, _x, _y, data):
-        top_row = _y * 16
+        offset = _y * 16 * self.row_size + _x
+        end = offset + len(data) * self.row_size
 
-        for row, content in enumerate(data):
-            self.framebuffer[top_row + row][_x] = content
+        self.framebuffer[offset:end:self.row_size] = bytearray(data)
 
     def binary_content(self, content):
-      b = bytearray()
-      for x in content:
-        if x:
-          b.append("1")
-        else:
-          b.append("0")
-      return b
+        # Debug helper showing each byte as either "0" (zero) or "1"
+        return bytearray(content).translate(BINARY_CONTENT_TABLE)
 
     def write_framebuffer(self, fb):
         # TODO: Bounds checking
         #for x, y in zip(range(0, 200), range(0, 200)):
         #  self.framebuffer[y][x] = 1
-        for row, content in enumerate(fb.framebuffer):
-          self.framebuffer[fb.origin_y + row][fb.origin_x:fb.end_x] = content
+        nr_bytes = min(fb.size_x, self.row_size - fb.origin_x)
+        nr_rows = min(fb.size_y, self.size_y - fb.origin_y)
+        for row in range(nr_rows):
+          src = row * fb.row_size
+          dest = (fb.origin_y + row) * self.row_size + fb.origin_x
+          self.framebuffer[dest:dest + nr_bytes] = fb.framebuffer[
+              src:src + nr_bytes]
           #logging.info("content: %s", self.binary_content(content))
           #targetRow = self.framebuffer[srcFramebuffer.origin_y]
           #self.framebuffer[fb.origin_y + row][fb.origin_x:fb.end_x] = [1] * fb.size_x
@@ -564,26 +635,33 @@ class Framebuffer(object):
             return
 
         shift_bits = _x & 7
-        carry_bits = 8 - shift_bits
 
         start_column = _x // 8
 
+        # Each row is shifted and merged into the framebuffer as a single
+        # integer, rather than carrying bits over from byte to byte.
+        output = self.framebuffer
         for row, row_data in enumerate(bitmap):
-            output_row = self.framebuffer[_y+row]
-            carry = output_row[start_column] & (0xff << carry_bits)
+            if not 0 <= _y + row < self.size_y:
+                # Slice assignment beyond the framebuffer would grow it
+                continue
+            offset = (_y + row) * self.row_size + start_column
             nr_columns = min(len(row_data), self.size_x - start_column)
-
-            for col in range(nr_columns):
-                output_row[start_column + col] = (
-                    carry | (row_data[col] >> shift_bits))
-                carry = (row_data[col] << carry_bits) & 0xff
-
-            if shift_bits > 0:
-                # Write out carry, but avoid writing beyond the end of the row.
-                end_column = nr_columns + start_column
-                if end_column < self.size_x:
-                    output_row[end_column] = (
-                        (output_row[end_column] & (0xff >> shift_bits)) | carry)
+            if nr_columns <= 0:
+                continue
+
+            # Include the byte receiving the shifted out bits, but avoid
+            # writing beyond the end of the row.
+            nr_bytes = nr_columns
+            if shift_bits > 0 and nr_columns + start_column < self.size_x:
+                nr_bytes += 1
+            pad_bits = 8 * (nr_bytes - nr_columns)
+
+            data = _to_long(bytearray(row_data[:nr_columns]))
+            mask = ((1 << (8 * nr_columns)) - 1) << pad_bits >> shift_bits
+            current = _to_long(output[offset:offset + nr_bytes])
+            output[offset:offset + nr_bytes] = _from_long(
+                (current & ~mask) | (data << pad_bits >> shift_bits), nr_bytes)
 
     def get_dimensions(self):
         return (self.nr_columns, self.nr_rows)
@@ -741,10 +819,7 @@ class ST7796S(object):
 
     def send(self, cmds):
         stream = PackBitsStream(self.oid, self.send_cmd)
-
-        for cmd in cmds:
-            stream.add_command(cmd)
-
+        stream.add_commands(cmds)
         stream.flush()
 
     def flush(self):
@@ -3,6 +3,7 @@
 # Copyright (_c) 2020 Martijn van Buul <martijn.van.buul@gmail.com>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
+import itertools
 import math
 import struct
 from . import bus
@@ -27,6 +28,24 @@ XPT_CMD_Y_POS = ((5 << XPT_CTRL_SWITCH_SHIFT) | XPT_CTRL_START | XPT_CTRL_PD0 |
 
 XPT_ENABLE_PENIRQ = ((1 << XPT_CTRL_SWITCH_SHIFT) | XPT_CTRL_START)
 
+XPT_SAMPLE_COUNT = 3 # filter_data() is unrolled for this number of samples
+# Request all X/Y samples of a touch in a single transfer
+XPT_PAYLOAD_SAMPLES = bytes(bytearray(
+    [XPT_CMD_X_POS, 0x00, 0x00, XPT_CMD_Y_POS, 0x00, 0x00]
+    * XPT_SAMPLE_COUNT))
+# Samples that are all within this many LSB of each other are simply averaged
+XPT_SAMPLE_TOLERANCE = 4
+# Every conversion answers in the two bytes following its command byte
+XPT_SAMPLES = struct.Struct('>' + 'xHxH' * XPT_SAMPLE_COUNT)
+XPT_PAYLOAD_ENABLE_PENIRQ = bytes(bytearray([XPT_ENABLE_PENIRQ]))
+
+# Buttons are indexed in a coarse grid over the 12 bit touch coordinate range
+GRID_SHIFT = 7
+GRID_SIZE = 4096 >> GRID_SHIFT
+
+def _grid_index(value):
+    return min(max(int(value) >> GRID_SHIFT, 0), GRID_SIZE - 1)
+
 class XptConfigException(Exception):
     def __init__(self, value):
         super(XptConfigException, self).__init__(value)
@@ -34,20 +53,60 @@ class XptConfigException(Exception):
 
 def _parse_coordinate(coordinate_string):
     components = coordinate_string.strip().split(',')
+    if len(components) != 2:
+        raise XptConfigException(
+            "Malformed value '%s'" % (coordinate_string,))
 
     try:
-        pair = tuple(math.floor(float(p.strip())) for p in components)
+        return tuple(int(p) for p in components)
     except ValueError:
-        raise XptConfigException(
-            "Malformed value '%s'" % (coordinate_string,))
+        pass
 
-    if len(pair) != 2:
+    try:
+        return tuple(int(math.floor(float(p))) for p in components)
+    except ValueError:
         raise XptConfigException(
             "Malformed value '%s'" % (coordinate_string,))
 
-    return pair
+# Precompute the (y0, y1, x0, slope) of every polygon edge. The vertex list is
+# closed by repeating the first vertex, so the closing edge is not a special
+# case. Horizontal edges can never be crossed by a horizontal ray and are left
+# out.
+def _make_edges(xs, ys):
+    closed_xs = xs + xs[:1]
+    closed_ys = ys + ys[:1]
+    edges = []
+    for i in range(len(xs)):
+        x0, y0 = closed_xs[i], closed_ys[i]
+        x1, y1 = closed_xs[i + 1], closed_ys[i + 1]
+        if y0 != y1:
+            edges.append((y0, y1, x0, (x1 - x0) / (y1 - y0)))
+    return tuple(edges)
+
+# Even-odd rule (PNPOLY): count the polygon edges crossed by a horizontal ray
+# cast from (px, py) towards positive X. An edge only counts when one vertex is
+# above the ray and the other one is not, so vertices on the ray are handled
+# without special cases.
+def _point_in_polygon(px, py, edges):
+    crossings = 0
+    for y0, y1, x0, slope in edges:
+        if (y0 > py) != (y1 > py) and px < x0 + slope * (py - y0):
+            crossings += 1
+    return bool(crossings & 1)
+
+# A polygon is an axis aligned rectangle when it has four vertices and its
+# edges alternate between horizontal and vertical ones
+def _is_axis_aligned_rectangle(xs, ys):
+    if len(xs) != 4:
+        return False
+    if ys[0] == ys[1]:
+        return xs[1] == xs[2] and ys[2] == ys[3] and xs[3] == xs[0]
+    return xs[0] == xs[1] and ys[1] == ys[2] and xs[2] == xs[3] \
+        and ys[3] == ys[0]
 
 class Xpt2046MenuAction(object):
+    __slots__ = ('_menu', '_function')
+
     def __init__(self, menu, function):
         self._menu = menu
         self._function = function
@@ -56,6 +115,8 @@ class Xpt2046MenuAction(object):
         self._menu.key_event(self._function, eventtime)
 
 class Xpt2046GcodeAction(object):
+    __slots__ = ('_gcode', '_template')
+
     def __init__(self, printer, config, template_name):
         gcode_macro = printer.load_object(config, 'gcode_macro')
         self._gcode = printer.lookup_object("gcode")
@@ -66,6 +127,8 @@ class Xpt2046GcodeAction(object):
         self._gcode.run_script(self._template.render())
 
 class Xpt2046DummyAction(object):
+    __slots__ = ()
+
     # pylint: disable=R0201
     def invoke(self, eventtime):
         del eventtime
@@ -81,48 +144,46 @@ def _create_action(printer_object, config, action_prefix):
     return None
 
 class Xpt2046Button(object):
+    __slots__ = ('points', '_xs', '_ys', '_bbox', '_is_rectangle', '_edges')
+
     def __init__(self, points):
         self.points = []
 
-        max_x = None
         points = points.split('\n')
         for point in points:
             if point:
-                new_point = _parse_coordinate(point)
-                if max_x is None or max_x < new_point[0]:
-                    max_x = new_point[0]
-
-                self.points.append(new_point)
+                self.points.append(_parse_coordinate(point))
 
         if len(self.points) < 3:
             raise XptConfigException(
                 "Polygon with at least 3 vertices expected")
 
-        self._max_ray_x = max_x + 100 # X coordinate used for ray casting
-
-    def check_xy(self, location):
-        def ccw(_a, _b, _c):
-            return ((_c[1]-_a[1]) * (_b[0]-_a[0]) >
-                    (_b[1]-_a[1]) * (_c[0]-_a[0]))
-
-        def intersect(_a, _b, _c, _d):
-            return (ccw(_a, _c, _d) != ccw(_b, _c, _d) and
-                    ccw(_a, _b, _c) != ccw(_a, _b, _d))
-
-        result = False
-        # use a 0.1 offset (while polygon points are truncated) to ensure
-        # that the casted ray can never be colinear with a polygon vertex
-        outside_location = (self._max_ray_x, location[1] + 0.1)
-        for i in range(len(self.points)-1):
-            if intersect(self.points[i], self.points[i+1],
-                         location, outside_location):
-                result = not result
+        self._xs = tuple(float(p[0]) for p in self.points)
+        self._ys = tuple(float(p[1]) for p in self.points)
+        self._bbox = (min(self._xs), max(self._xs),
+                      min(self._ys), max(self._ys))
+        self._is_rectangle = _is_axis_aligned_rectangle(self._xs, self._ys)
+        self._edges = _make_edges(self._xs, self._ys)
 
-        if intersect(self.points[-1], self.points[0],
-                     location, outside_location):
-            result = not result
+    def get_bounding_box(self):
+        return self._bbox
 
-        return result
+    def check_xy(self, location):
+        _x, _y = location
+        min_x, max_x, min_y, max_y = self._bbox
+        if _x < min_x or _x > max_x or _y < min_y or _y > max_y:
+            return False
+        return self.check_xy_in_bbox(location)
+
+    # Same as check_xy(), for a location that is already known to be within
+    # the bounding box of the button
+    def check_xy_in_bbox(self, location):
+        _x, _y = location
+        if self._is_rectangle:
+            # Same result as the crossing test, which includes the minimum
+            # and excludes the maximum edge of a rectangle
+            return _x < self._bbox[1] and _y < self._bbox[3]
+        return _point_in_polygon(_x, _y, self._edges)
 
     # The following two methods are to be overridden by derived classes
 
@@ -137,6 +198,8 @@ class Xpt2046Button(object):
         pass
 
 class Xpt2046OneshotButton(Xpt2046Button):
+    __slots__ = ('_action',)
+
     def __init__(self, points, action):
         super(Xpt2046OneshotButton, self).__init__(points)
         self._action = action
@@ -147,6 +210,8 @@ class Xpt2046OneshotButton(Xpt2046Button):
         return None
 
 class Xpt2046RepeatingButton(Xpt2046Button):
+    __slots__ = ('_action', '_repeat_action')
+
     def __init__(self, points, action, repeat_action):
         super(Xpt2046RepeatingButton, self).__init__(points)
         self._action = action
@@ -163,6 +228,8 @@ class Xpt2046RepeatingButton(Xpt2046Button):
         return eventtime + REPEAT_INTERVAL
 
 class Xpt2046LongclickButton(Xpt2046Button):
+    __slots__ = ('_action', '_longclick_action')
+
     def __init__(self, points, action, longclick_action):
         super(Xpt2046LongclickButton, self).__init__(points)
 
@@ -201,9 +268,13 @@ class Xpt2046(object):
         self.busy = False
 
         # Discover soft buttons
-        for i in range(999):
+        for i in itertools.count():
             button_prefix = 'button%d' % (i,)
 
+            button_points = config.get(button_prefix + '_points', None)
+            if not button_points:
+                break
+
             func = _create_action(printer, config, button_prefix)
             if not func:
                 func = Xpt2046DummyAction()
@@ -214,11 +285,6 @@ class Xpt2046(object):
             long_func = _create_action(printer, config,
                                        button_prefix + '_longpress')
 
-            button_points = config.get(button_prefix + '_points', None)
-
-            if not button_points or not (repeat_func or long_func or func):
-                break
-
             try:
                 if repeat_func and long_func:
                     raise XptConfigException(
@@ -239,6 +305,32 @@ class Xpt2046(object):
                     "Error while parsing xp2046 button %d: %s"
                     %(i, err.value))
 
+        # Bounding boxes of all buttons as parallel tuples, indexed like
+        # self.buttons, so candidates are rejected without a method call
+        bboxes = [button.get_bounding_box() for button in self.buttons]
+        (self._min_xs, self._max_xs,
+         self._min_ys, self._max_ys) = tuple(zip(*bboxes)) or ((),) * 4
+
+        # Map every grid cell to the indices of the buttons whose bounding box
+        # overlaps it, in configuration order so that the first match wins
+        grid = [[] for _ in range(GRID_SIZE * GRID_SIZE)]
+        for index, (min_x, max_x, min_y, max_y) in enumerate(bboxes):
+            for cell_y in range(_grid_index(min_y), _grid_index(max_y) + 1):
+                for cell_x in range(_grid_index(min_x),
+                                    _grid_index(max_x) + 1):
+                    grid[cell_y * GRID_SIZE + cell_x].append(index)
+        self._grid = [tuple(cell) for cell in grid]
+
+        # The last button that was hit is tested first on the next touch. This
+        # is only allowed when no earlier button overlaps it, otherwise the
+        # first match in configuration order would no longer win.
+        self._last_hit = None
+        self._cacheable = tuple(
+            not any(min_x <= bboxes[other][1] and bboxes[other][0] <= max_x
+                    and min_y <= bboxes[other][3] and bboxes[other][2] <= max_y
+                    for other in range(index))
+            for index, (min_x, max_x, min_y, max_y) in enumerate(bboxes))
+
         self._gcode.register_command(
             "XPT_TOUCH_REPORT", self._cmd_touch_report,
             desc="Enable/disable touch panel reporting")
@@ -255,20 +347,36 @@ class Xpt2046(object):
             if self.report_enabled:
                 self._gcode.respond_info("XPT2046 touch: (%d,%d)" % result)
 
-            for button_candidate in self.buttons:
-                if button_candidate.check_xy(result):
-                    self._active_button = button_candidate
-                    desired_callback = button_candidate.clicked(eventtime)
-                    if desired_callback:
-                        self._reactor.update_timer(self._repeat_timer,
-                                                   desired_callback)
-                    break
+            index = self._last_hit
+            if index is None or not self.buttons[index].check_xy(result):
+                index = self._find_button(result)
+            if index is not None:
+                if self._cacheable[index]:
+                    self._last_hit = index
+                button_candidate = self.buttons[index]
+                self._active_button = button_candidate
+                desired_callback = button_candidate.clicked(eventtime)
+                if desired_callback:
+                    self._reactor.update_timer(self._repeat_timer,
+                                               desired_callback)
         else:
             if self.report_enabled:
                 self._gcode.respond_info("XPT2046 release")
 
             self._active_button = None
 
+    # Returns the index of the first button containing the location, or None
+    def _find_button(self, location):
+        _x, _y = location
+        cell = _grid_index(_y) * GRID_SIZE + _grid_index(_x)
+        for index in self._grid[cell]:
+            if (_x < self._min_xs[index] or _x > self._max_xs[index] or
+                    _y < self._min_ys[index] or _y > self._max_ys[index]):
+                continue
+            if self.buttons[index].check_xy_in_bbox(location):
+                return index
+        return None
+
     def _repeat_event(self, eventtime):
         desired_callback = None
         if self._active_button:
@@ -290,98 +398,72 @@ class Xpt2046(object):
         logging.info("init xpt touch panel")
         # Ensure chip is in the correct powerdown mode.
         #self._spi.spi_send([0xD0, 0x00])
-        self._spi.spi_send([XPT_ENABLE_PENIRQ])
+        self._spi.spi_send(XPT_PAYLOAD_ENABLE_PENIRQ)
         #self._spi.spi_send([CTRL_HI_Y | CTRL_LO_DFR, 0x00])
     
-    def stdev(self, value_tuples):
-        x, y = zip(*value_tuples)
-        n = len(value_tuples)
-        x_mean = sum(x) / n
-        y_mean = sum(y) / n
-        x_var = sum((_x - x_mean) ** 2 for _x in x) / n
-        y_var = sum((_y - y_mean) ** 2 for _y in y) / n
-        x_dev = x_var ** 0.5
-        y_dev = y_var ** 0.5
-    
-        return (x_dev, y_dev)
+    # Takes the three (x, y) samples of a touch, discards the samples that
+    # deviate more than limit_multiplier standard deviations from the mean on
+    # either axis and returns the mean of the remaining samples. The
+    # statistics are unrolled for the fixed number of samples.
+    def filter_data(self, data, limit_multiplier=1.3):
+        (x0, y0), (x1, y1), (x2, y2) = data
+        x_mean = (x0 + x1 + x2) / 3.
+        y_mean = (y0 + y1 + y2) / 3.
+        dx0, dx1, dx2 = x0 - x_mean, x1 - x_mean, x2 - x_mean
+        dy0, dy1, dy2 = y0 - y_mean, y1 - y_mean, y2 - y_mean
+        x_cut_off = math.sqrt((dx0 * dx0 + dx1 * dx1 + dx2 * dx2) / 3.) \
+            * limit_multiplier
+        y_cut_off = math.sqrt((dy0 * dy0 + dy1 * dy1 + dy2 * dy2) / 3.) \
+            * limit_multiplier
+
+        ok_x = ok_y = 0
+        ok_count = 0
+        for _x, _y in data:
+            if abs(_x - x_mean) <= x_cut_off and abs(_y - y_mean) <= y_cut_off:
+                ok_x += _x
+                ok_y += _y
+                ok_count += 1
+
+        if not ok_count:
+            return None, None
+
+        return (float(ok_x) / ok_count, float(ok_y) / ok_count)
 
-    def mean(self, value_tuples):
-        n = len(value_tuples)
-        x, y = zip(*value_tuples)
-        
-        return (sum(x) / n, sum(y) / n)
-
-    # takes tuples of (x, y) values
-    def filter_data(self, data, limit_multiplier = 1.3):
-        try:
-          deviations = self.stdev(data)
-          means = self.mean(data)        
-        except ValueError as e:
-          logging.exception(e)
-          return (-1, -1)
-
-        anomaly_cut_off_x = deviations[0] * limit_multiplier
-        anomaly_cut_off_y = deviations[0] * limit_multiplier
-        anomaly_cut_off_y = deviations[1] * limit_multiplier
-        anomaly_cut_off_y = deviations[1] * limit_multiplier
-
-        
-        x_lower_limit = means[0] - anomaly_cut_off_x
-        x_upper_limit = means[0] + anomaly_cut_off_x
-        y_lower_limit = means[1] - anomaly_cut_off_y
-        y_upper_limit = means[1] + anomaly_cut_off_y
-        
-        ok_data = []
-        
-        for point in data:
-            if point[0] <= x_upper_limit and \
-              point[0] >= x_lower_limit and \
-              point[1] <= y_upper_limit and \
-              point[1] >= y_lower_limit:
-                ok_data.append(point)
-        
-        if len(ok_data) == 0:
-          return None, None
-
-        return self.mean(ok_data)
-        
     def _get_touch_xy(self):
         # logging.info("get position touch")
         try:
-          positions = []
-          #x = [None] * 3
-          #y = [None] * 3
-          for i in range(3):
-            # B1 (BBBB BBBB) 
-            # B2 (BBBB BPPP) Byte 2 incomming data is padded by 3 bits
-            # B3 = B1 << 8 | B2
-            # B3 (BBBB BBBB BBBB B000)
-            # B4 B3 >> 3
-            # B4 (000B BBBB BBBB BBBB)
-            #self._spi.spi_transfer([XPT_CMD_X_POS, 0x00, 0x00, XPT_CMD_X_POS, 0x00, 0x00])
-            payload = [XPT_CMD_X_POS, 0x00, 0x00]
-            resp = self._spi.spi_transfer(payload)['response']
-            x_pos = (ord(resp[1]) << 8 | ord(resp[2])) >> 3
-            #x[i] = x_pos
-            
-            #self._spi.spi_send([XPT_CMD_Y_POS])
-            payload = [XPT_CMD_Y_POS, 0x00, 0x00]
-            resp = self._spi.spi_transfer(payload)['response']
-            y_pos = (ord(resp[1]) << 8 | ord(resp[2])) >> 3
-            #y[i] = y_pos
-
-            positions.append((y_pos, x_pos))
-
-            logging.info("sample: %s, x: %s, y: %s", i, x_pos, y_pos)
+          resp = self._spi.spi_transfer(XPT_PAYLOAD_SAMPLES)['response']
+          samples = XPT_SAMPLES.unpack_from(resp)
         except Exception as e: # KeyError it seems
           logging.info(e)
           return None
         finally:
-          self._spi.spi_send([XPT_ENABLE_PENIRQ])
-
-        _x, _y = self.filter_data(positions)
+          self._spi.spi_send(XPT_PAYLOAD_ENABLE_PENIRQ)
+
+        positions = []
+        for i in range(XPT_SAMPLE_COUNT):
+          # B1 (BBBB BBBB)
+          # B2 (BBBB BPPP) Byte 2 incomming data is padded by 3 bits
+          # B3 = B1 << 8 | B2
+          # B3 (BBBB BBBB BBBB B000)
+          # B4 B3 >> 3
+          # B4 (000B BBBB BBBB BBBB)
+          x_pos = samples[2 * i] >> 3
+          y_pos = samples[2 * i + 1] >> 3
+          positions.append((y_pos, x_pos))
+
+          logging.debug("sample: %s, x: %s, y: %s", i, x_pos, y_pos)
+
+        xs, ys = zip(*positions)
+        if (max(xs) - min(xs) < XPT_SAMPLE_TOLERANCE
+                and max(ys) - min(ys) < XPT_SAMPLE_TOLERANCE):
+            # Clean press, there is nothing to filter
+            _x = float(sum(xs)) / XPT_SAMPLE_COUNT
+            _y = float(sum(ys)) / XPT_SAMPLE_COUNT
+        else:
+            _x, _y = self.filter_data(positions)
 
-        logging.info("Touch position x: %s, y: %s", _x, _y)
+        logging.debug("Touch position x: %s, y: %s", _x, _y)
         return (_x, _y)
 
 def load_config_prefix(config):